@@ -1,9 +1,12 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 from datetime import date
-import matplotlib.pyplot as plt
+from PIL import Image, ImageDraw, ImageFont
 import io
+import tempfile
+import xlsxwriter
 
 # ---------------------------------------------------------
 # CONFIGURACIÓN GENERAL
@@ -15,158 +18,371 @@ st.set_page_config(
 )
 
 FILE_PATH = "DeudoresPrueba.xlsx"
+STORE_PATH = "DeudoresPrueba.parquet"
+# La fuente por defecto de Pillow no trae Ñ ni tildes
+FONT_PATH = os.path.join("fonts", "DejaVuSans.ttf")
+# Cada guardado crea una llave nueva en las cachés de totales, imagen y
+# Excel: solo se conservan las últimas versiones, no una por guardado
+MAX_VERSIONES = 4
 
 # ---------------------------------------------------------
 # CARGA DE DATOS
 # ---------------------------------------------------------
-if os.path.exists(FILE_PATH):
+# Tipos de entrada de limpiar_df, para que un df vacío ya nazca tipado
+# (a la salida ordenar_df deja Cliente como categórico)
+TIPOS = {
+    "Consecutivo": "int32",
+    "Cliente": "string[pyarrow]",
+    "Fecha": "datetime64[ns]",
+    "Valor": "int64",
+    "Pagado": "bool",
+}
+COLUMNAS = list(TIPOS)
+PAGADO_SI = frozenset({"1", "1.0", "TRUE", "PAGADO", "SI", "SÍ", "YES"})
+
+
+# La versión solo se usa como llave de caché: al guardar cambia y se relee
+@st.cache_data(show_spinner=False)
+def load_df(path, version):
+    # Columnas respaldadas por pyarrow: Cliente llega como string[pyarrow] y
+    # la limpieza de texto no tiene que crear un objeto Python por fila
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, dtype_backend="pyarrow")
+    # calamine requiere pandas >= 2.2 y python-calamine; si falta, openpyxl
     try:
-        df = pd.read_excel(FILE_PATH)
-    except Exception:
-        df = pd.DataFrame(columns=["Consecutivo", "Cliente", "Fecha", "Valor", "Pagado"])
-else:
-    df = pd.DataFrame(columns=["Consecutivo", "Cliente", "Fecha", "Valor", "Pagado"])
+        return pd.read_excel(path, engine="calamine", dtype_backend="pyarrow")
+    except (ImportError, ValueError):
+        return pd.read_excel(
+            path,
+            engine="openpyxl",
+            engine_kwargs={"read_only": True, "data_only": True, "keep_links": False},
+            dtype_backend="pyarrow"
+        )
+
+
+# mtime en nanosegundos más el tamaño: getmtime (float) puede repetirse
+# entre dos guardados seguidos o en sistemas de archivos de baja resolución
+def version_archivo(path):
+    info = os.stat(path)
+    return info.st_mtime_ns, info.st_size
+
+
+# El Excel solo se lee mientras no exista el almacén parquet
+def ruta_datos():
+    for path in (STORE_PATH, FILE_PATH):
+        if os.path.exists(path):
+            return path, version_archivo(path)
+    return None, None
+
+
+# Vectorizado sobre cadenas de pyarrow: quita espacios de ancho cero, junta
+# espacios repetidos y pasa a mayúsculas ("juan  david" == "JUAN DAVID")
+def normalizar_cliente(clientes):
+    return (
+        clientes.astype("string[pyarrow]")
+        .str.replace("\u200b", "", regex=False)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+        .str.upper()
+    )
 
-# Asegurar columnas
-for col in ["Consecutivo", "Cliente", "Fecha", "Valor", "Pagado"]:
-    if col not in df.columns:
-        df[col] = None
 
-# Limpieza básica
-df["Cliente"] = df["Cliente"].astype(str).str.strip().str.upper()
-df["Fecha"] = pd.to_datetime(df["Fecha"], errors="coerce").dt.date
-df["Valor"] = pd.to_numeric(df["Valor"], errors="coerce").fillna(0)
+def limpiar_df(df, normalizado=False):
+    # Asegurar columnas (las que falten quedan como NaN, no como objetos None)
+    df = df.reindex(columns=COLUMNAS)
 
-df["Pagado"] = df["Pagado"].astype(bool)
+    # Eliminar filas completamente vacías
+    df = df.dropna(how="all")
 
-# Eliminar filas completamente vacías
-df = df.dropna(how="all")
+    # Limpieza básica
+    # save() siempre escribe Cliente ya normalizado: desde el store basta el tipo
+    if normalizado:
+        df["Cliente"] = df["Cliente"].astype("string[pyarrow]").fillna("")
+    else:
+        df["Cliente"] = normalizar_cliente(df["Cliente"]).fillna("")
+    # read_excel suele entregar Fecha ya como datetime64: no se vuelve a parsear
+    if not pd.api.types.is_datetime64_any_dtype(df["Fecha"]):
+        df["Fecha"] = pd.to_datetime(
+            df["Fecha"], errors="coerce", format="mixed", cache=True
+        )
+    # datetime64 de numpy en todo el flujo: el editor y xlsxwriter lo aceptan
+    # tal cual y no hay que convertir a objetos date en cada carga
+    df["Fecha"] = df["Fecha"].astype("datetime64[ns]")
+    # COP no maneja centavos: pesos enteros en int64. Primero a float64 de
+    # numpy: con pyarrow el NaN de to_numeric no siempre cuenta como nulo y
+    # fillna lo dejaba pasar al cast (quedaba -9223372036854775808)
+    valor = pd.to_numeric(df["Valor"], errors="coerce").astype("float64")
+    # Vacío, texto, infinito o negativo cuentan como 0, como en el editor
+    valor = valor.where(np.isfinite(valor) & (valor >= 0), 0)
+    df["Valor"] = valor.round().astype("int64")
+
+    # Pagado solo si el valor es uno de PAGADO_SI; vacío, "NO" o "FALSE"
+    # cuentan como pendiente (astype(bool) los volvía True)
+    df["Pagado"] = (
+        df["Pagado"].astype("string").str.strip().str.upper().isin(PAGADO_SI)
+    )
+    return ordenar_df(df)
 
-# Eliminar pagados
-df = df[df["Pagado"] != True]
 
-# Ordenar
-df = df.sort_values(by="Cliente")
+# Solo filtra, ordena y renumera: basta para filas que ya vienen limpias
+# (registro nuevo o celdas editadas), sin repetir la limpieza de todo df
+def ordenar_df(df):
+    # Eliminar pagados
+    df = df[~df["Pagado"].astype(bool)]
 
-# Reindexar consecutivo
-df = df.reset_index(drop=True)
-df["Consecutivo"] = df.index + 1
+    # Ordenar; el archivo guardado ya viene ordenado, así que al cargarlo
+    # basta con una pasada O(N) para comprobarlo
+    if not df["Cliente"].is_monotonic_increasing:
+        df = df.sort_values(by="Cliente")
 
-# ---------------------------------------------------------
-# TÍTULO
-# ---------------------------------------------------------
-st.title("💸 App de Registro de Deudores")
+    # Reindexar consecutivo
+    df = df.reset_index(drop=True)
+    df["Consecutivo"] = np.arange(1, len(df) + 1, dtype=np.int32)
 
-# ---------------------------------------------------------
-# REGISTRAR NUEVO DEUDOR
-# ---------------------------------------------------------
-st.subheader("➕ Registrar nuevo deudor")
+    # Categórico al final para que solo queden los clientes con deuda
+    df["Cliente"] = df["Cliente"].astype("category").cat.remove_unused_categories()
+    return df
 
-c1, c2, c3 = st.columns(3)
 
-with c1:
-    cliente = st.text_input("Cliente").strip().upper()
+def df_vacio():
+    return pd.DataFrame({col: pd.Series(dtype=tipo) for col, tipo in TIPOS.items()})
 
-with c2:
-    fecha = st.date_input(
-        "Fecha",
-        value=date.today(),
-        max_value=date.today(),
-        key="fecha_nuevo"
-    )
 
-with c3:
-    valor = st.number_input(
-        "Valor (COP)",
-        min_value=0.0,
-        step=1000.0,
-        format="%.0f"
-    )
-
-if st.button("Guardar nuevo registro"):
-    if cliente == "":
-        st.error("El cliente es obligatorio.")
+# Segunda capa de caché: la limpieza corre una vez por versión del archivo
+@st.cache_data(show_spinner=False)
+def load_clean_df(path, version):
+    if path is None:
+        df = df_vacio()
     else:
-        nuevo = {
-            "Consecutivo": len(df) + 1,
-            "Cliente": cliente,
-            "Fecha": fecha,
-            "Valor": valor,
-            "Pagado": False
-        }
-        df = pd.concat([df, pd.DataFrame([nuevo])], ignore_index=True)
-        df.to_excel(FILE_PATH, index=False)
-        st.success("Registro guardado.")
-        st.rerun()
+        try:
+            df = load_df(path, version)
+        except Exception:
+            df = df_vacio()
+    return limpiar_df(df, normalizado=path == STORE_PATH)
+
+
+def save(df):
+    # Se escribe a un temporal y se reemplaza de una vez: si el proceso muere
+    # a mitad de la escritura, el archivo anterior queda intacto. El nombre es
+    # único por guardado (dos sesiones pueden guardar a la vez) y queda en la
+    # misma carpeta para que os.replace no cruce de sistema de archivos
+    carpeta = os.path.dirname(os.path.abspath(STORE_PATH))
+    fd, tmp = tempfile.mkstemp(dir=carpeta, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+            df.to_parquet(f, index=False, compression="zstd")
+        os.replace(tmp, STORE_PATH)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    # Las entradas de la versión anterior ya no sirven: liberar la memoria
+    load_df.clear()
+    load_clean_df.clear()
+
+    # Lo guardado pasa a ser la copia de la sesión, sin releer el disco
+    st.session_state.df = df
+    st.session_state.version = version_archivo(STORE_PATH)
+
+
+# El DataFrame vive en la sesión. Basta un stat para notar que otra sesión
+# guardó; en ese caso se recarga en vez de pisar sus cambios. Los fragmentos
+# reciben el df de la última ejecución completa, así que sus botones de
+# guardar también lo llaman antes de modificar
+def df_actual():
+    path, version = ruta_datos()
+    if "df" not in st.session_state or st.session_state.get("version") != version:
+        st.session_state.df = load_clean_df(path, version)
+        st.session_state.version = version
+    return st.session_state.df
+
+
+df = df_actual()
+
+# Llave barata para las cachés que dependen del contenido de df: cada
+# versión del archivo corresponde a un único df limpio
+df_version = st.session_state.version
 
 # ---------------------------------------------------------
-# FILTRO
+# TÍTULO
 # ---------------------------------------------------------
-st.subheader("🔎 Filtro por cliente")
-
-clientes = sorted(df["Cliente"].unique())
-filtro = st.selectbox("Cliente", ["Todos"] + clientes)
+st.title("💸 App de Registro de Deudores")
 
-df_view = df if filtro == "Todos" else df[df["Cliente"] == filtro]
+if "aviso" in st.session_state:
+    st.warning(st.session_state.pop("aviso"))
 
 # ---------------------------------------------------------
-# TABLA EDITABLE
+# REGISTRAR NUEVO DEUDOR
 # ---------------------------------------------------------
-st.subheader("✏️ Editar / Marcar como pagado")
+# Cada sección es un fragmento: sus widgets solo vuelven a ejecutar esa
+# sección, y st.rerun() dentro de un fragmento recarga toda la app
+@st.fragment
+def registrar_deudor(df):
+    st.subheader("➕ Registrar nuevo deudor")
+
+    c1, c2, c3 = st.columns(3)
 
-df_edit = df_view.copy()
-df_edit["Fecha"] = pd.to_datetime(df_edit["Fecha"])
+    with c1:
+        cliente = normalizar_cliente(pd.Series([st.text_input("Cliente")])).iloc[0]
 
-edited = st.data_editor(
-    df_edit,
-    use_container_width=True,
-    hide_index=True,
-    disabled=["Consecutivo"],
-    column_config={
-        "Fecha": st.column_config.DateColumn(
+    with c2:
+        fecha = st.date_input(
             "Fecha",
-            max_value=date.today()
-        ),
-        "Valor": st.column_config.NumberColumn(
+            value=date.today(),
+            max_value=date.today(),
+            key="fecha_nuevo"
+        )
+
+    with c3:
+        valor = st.number_input(
             "Valor (COP)",
-            min_value=0,
-            step=1000,
+            min_value=0.0,
+            step=1000.0,
             format="%.0f"
-        ),
-        "Pagado": st.column_config.CheckboxColumn("Pagado")
-    }
-)
+        )
+
+    if st.button("Guardar nuevo registro"):
+        if cliente == "":
+            st.error("El cliente es obligatorio.")
+        else:
+            # El registro nuevo se agrega sobre lo último guardado en disco, en
+            # una copia: la de la sesión solo cambia si save() termina bien
+            df = df_actual().copy()
+            # Consecutivo lo asigna ordenar_df al renumerar
+            df.loc[len(df)] = [pd.NA, cliente, pd.Timestamp(fecha), round(valor), False]
+            df = ordenar_df(df)
+            save(df)
+            st.success("Registro guardado.")
+            st.rerun()
 
-if st.button("💾 Guardar cambios"):
-    df_new = df.copy()
 
-    for _, row in edited.iterrows():
-        idx = df_new[df_new["Consecutivo"] == row["Consecutivo"]].index
-        if len(idx) > 0:
-            i = idx[0]
-            df_new.at[i, "Cliente"] = row["Cliente"].strip().upper()
-            df_new.at[i, "Fecha"] = row["Fecha"].date()
-            df_new.at[i, "Valor"] = float(row["Valor"])
-            df_new.at[i, "Pagado"] = bool(row["Pagado"])
+registrar_deudor(df)
 
-    df_new = df_new[df_new["Pagado"] != True]
-    df_new = df_new.sort_values(by="Cliente")
-    df_new = df_new.reset_index(drop=True)
-    df_new["Consecutivo"] = df_new.index + 1
+# ---------------------------------------------------------
+# FILTRO Y TABLA EDITABLE
+# ---------------------------------------------------------
+# edited_rows del editor: {posición en la tabla: {columna: valor nuevo}}
+def aplicar_cambios(df, consecutivos, edited_rows):
+    cambios = pd.DataFrame.from_dict(edited_rows, orient="index")
+    cambios.index = consecutivos[cambios.index.to_numpy(dtype=int)]
+
+    if "Cliente" in cambios:
+        cambios["Cliente"] = normalizar_cliente(cambios["Cliente"])
+    if "Fecha" in cambios:
+        cambios["Fecha"] = pd.to_datetime(
+            cambios["Fecha"], errors="coerce", format="mixed"
+        )
+    if "Valor" in cambios:
+        cambios["Valor"] = pd.to_numeric(cambios["Valor"], errors="coerce").round()
+
+    # update() solo escribe las celdas editadas (ignora los NaN); Cliente
+    # vuelve a texto porque un categórico no admite nombres nuevos
+    df_new = df.astype({"Cliente": str}).set_index("Consecutivo")
+    df_new.update(cambios)
+    return ordenar_df(df_new.reset_index())
+
+
+@st.fragment
+def editar_deudores(df):
+    st.subheader("🔎 Filtro por cliente")
+
+    # Las categorías ya están ordenadas y sin repetidos: no hay que recorrer df
+    clientes = df["Cliente"].cat.categories.tolist()
+    filtro = st.selectbox("Cliente", ["Todos"] + clientes)
+
+    df_view = df if filtro == "Todos" else df[df["Cliente"] == filtro]
+
+    st.subheader("✏️ Editar / Marcar como pagado")
+
+    # Cliente como texto, para que el editor no lo muestre como lista
+    # cerrada; con copy-on-write (pandas >= 3) assign comparte las demás
+    # columnas, en pandas 2.x sin CoW activado las copia igual que copy()
+    df_edit = df_view.assign(Cliente=df_view["Cliente"].astype(str))
+
+    # La llave cambia con el filtro y tras cada guardado, así las
+    # posiciones de edited_rows siempre corresponden a la tabla mostrada
+    editor_key = f"editor_{filtro}_{st.session_state.get('editor_version', 0)}"
+
+    st.data_editor(
+        df_edit,
+        key=editor_key,
+        use_container_width=True,
+        hide_index=True,
+        disabled=["Consecutivo"],
+        column_config={
+            "Fecha": st.column_config.DateColumn(
+                "Fecha",
+                max_value=date.today()
+            ),
+            "Valor": st.column_config.NumberColumn(
+                "Valor (COP)",
+                min_value=0,
+                step=1000,
+                format="%.0f"
+            ),
+            "Pagado": st.column_config.CheckboxColumn("Pagado")
+        }
+    )
 
-    df_new.to_excel(FILE_PATH, index=False)
-    st.success("Cambios guardados correctamente.")
-    st.rerun()
+    if st.button("💾 Guardar cambios"):
+        edited_rows = st.session_state[editor_key]["edited_rows"]
+        if not edited_rows:
+            st.info("No hay cambios por guardar.")
+        elif df_actual() is not df:
+            # Otra sesión guardó: los consecutivos de la tabla ya no son
+            # confiables, así que se recarga en vez de aplicar las ediciones
+            st.session_state.editor_version = (
+                st.session_state.get("editor_version", 0) + 1
+            )
+            st.session_state.aviso = (
+                "Otra sesión guardó cambios mientras editabas. Se cargaron los "
+                "datos actuales; vuelve a hacer tus cambios."
+            )
+            st.rerun()
+        else:
+            df_new = aplicar_cambios(
+                df, df_edit["Consecutivo"].to_numpy(), edited_rows
+            )
+
+            save(df_new)
+            st.session_state.editor_version = (
+                st.session_state.get("editor_version", 0) + 1
+            )
+            st.success("Cambios guardados correctamente.")
+            st.rerun()
+
+
+editar_deudores(df)
 
 # ---------------------------------------------------------
 # TOTALES
 # ---------------------------------------------------------
 st.subheader("📊 Total por cliente")
 
+# bincount sobre los códigos del categórico evita el despacho por grupo de
+# groupby; ordenar_df quita las categorías sin uso, así que todas se observan
+@st.cache_data(show_spinner=False, max_entries=MAX_VERSIONES)
+def totales_por_cliente(df_version, _df):
+    clientes = _df["Cliente"].cat.categories
+    valores = np.bincount(
+        _df["Cliente"].cat.codes.to_numpy(),
+        weights=_df["Valor"].to_numpy(dtype="float64"),
+        minlength=len(clientes)
+    )
+    return pd.DataFrame({"Cliente": clientes, "Valor": valores.astype("int64")})
+
+
 if len(df) > 0:
-    totales = df.groupby("Cliente")["Valor"].sum().reset_index()
-    totales["Valor"] = totales["Valor"].apply(lambda x: f"${x:,.0f}")
-    st.dataframe(totales, use_container_width=True)
+    totales = totales_por_cliente(df_version, df)
+    # El navegador da formato a la columna; Valor sigue siendo numérico.
+    # El separador de miles (%,d) lo soporta el frontend desde Streamlit 1.55
+    st.dataframe(
+        totales,
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Valor": st.column_config.NumberColumn("Valor", format="$%,d")
+        }
+    )
 
     gran_total = df["Valor"].sum()
     st.subheader(f"💰 Gran total: **${gran_total:,.0f}**")
@@ -178,20 +394,52 @@ else:
 # ---------------------------------------------------------
 st.subheader("🖼️ Descargar imagen del total por cliente")
 
-if len(df) > 0:
-    fig, ax = plt.subplots(figsize=(6, len(totales) * 0.5 + 1))
-    ax.axis("off")
-
-    ax.table(
-        cellText=totales.values,
-        colLabels=totales.columns,
-        cellLoc="center",
-        loc="center"
-    )
+# El PNG solo se vuelve a dibujar cuando cambian los totales (editar una
+# fecha cambia df pero no la imagen)
+@st.cache_data(show_spinner=False, max_entries=MAX_VERSIONES)
+def totales_png(totales_hash, _totales):
+    # La tabla se pinta directo con Pillow: para dos columnas de texto no
+    # hace falta el motor de figuras de matplotlib
+    filas = [list(_totales.columns)] + [
+        [cliente, f"${valor:,.0f}"]
+        for cliente, valor in _totales.itertuples(index=False, name=None)
+    ]
+    try:
+        fuente = ImageFont.truetype(FONT_PATH, 16)
+    except OSError:
+        fuente = ImageFont.load_default(size=16)
+
+    # Cada columna tan ancha como su texto más largo, más el margen
+    margen, alto = 12, 30
+    anchos = [
+        int(max(fuente.getlength(fila[c]) for fila in filas)) + 2 * margen
+        for c in range(len(filas[0]))
+    ]
+
+    img = Image.new("RGB", (sum(anchos) + 1, alto * len(filas) + 1), "white")
+    draw = ImageDraw.Draw(img)
+    for r, fila in enumerate(filas):
+        x, y = 0, r * alto
+        for texto, ancho in zip(fila, anchos):
+            draw.rectangle([x, y, x + ancho, y + alto], outline="black")
+            draw.text(
+                (x + ancho / 2, y + alto / 2),
+                texto,
+                fill="black",
+                font=fuente,
+                anchor="mm"
+            )
+            x += ancho
 
     buffer_img = io.BytesIO()
-    plt.savefig(buffer_img, format="png", bbox_inches="tight", dpi=300)
-    buffer_img.seek(0)
+    img.save(buffer_img, format="PNG")
+    return buffer_img.getvalue()
+
+
+@st.fragment
+def descargar_imagen(totales):
+    totales_hash = int(pd.util.hash_pandas_object(totales, index=False).sum())
+    buffer_img = totales_png(totales_hash, totales)
 
     st.image(buffer_img)
     st.download_button(
@@ -201,18 +449,43 @@ if len(df) > 0:
         mime="image/png"
     )
 
+
+if len(df) > 0:
+    descargar_imagen(totales)
+
 # ---------------------------------------------------------
 # DESCARGAR EXCEL
 # ---------------------------------------------------------
 st.subheader("⬇️ Descargar Excel actualizado")
 
-output = io.BytesIO()
-df.to_excel(output, index=False)
-output.seek(0)
+# El Excel solo se serializa cuando cambia el contenido de df.
+# constant_memory exige escribir fila por fila; to_excel escribe por
+# columnas y en ese modo perdería datos, por eso se usa xlsxwriter directo
+@st.cache_data(show_spinner=False, max_entries=MAX_VERSIONES)
+def xlsx_bytes(df_version, _df):
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(
+        output, {"constant_memory": True, "default_date_format": "yyyy-mm-dd"}
+    )
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, _df.columns)
 
-st.download_button(
-    "Descargar Excel",
-    data=output,
-    file_name="DeudoresPrueba.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-)
+    filas = _df.astype(object).where(_df.notna(), None)
+    for i, fila in enumerate(filas.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(i, 0, fila)
+
+    workbook.close()
+    return output.getvalue()
+
+
+@st.fragment
+def descargar_excel(df, df_version):
+    st.download_button(
+        "Descargar Excel",
+        data=xlsx_bytes(df_version, df),
+        file_name="DeudoresPrueba.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+
+descargar_excel(df, df_version)